@@ -8,19 +8,31 @@
 #
 # Author(s): Cody Buell
 #
-# Requisite:
+# Requisite: pip3: requests aiohttp aiofiles
 #
 # Resources:
 #
 # Usage: export SLACK_TOKEN=[yourslacktoken]; python3 get_emoji.py
 
 
-import re
 import os
 import sys
 import json
-import shutil
+import asyncio
+import functools
+from typing import Callable
+import aiohttp
+import aiofiles
 import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+# number of attempts for each slack api call and image download
+retries = 3
+
+# session for the emoji.list api call, image downloads go through aiohttp
+session = requests.Session()
+session.mount('https://', HTTPAdapter(max_retries=retries))
 
 
 def request(method_type: str, url: str, headers: dict, *args: dict) -> requests.Response:
@@ -38,13 +50,102 @@ def request(method_type: str, url: str, headers: dict, *args: dict) -> requests.
     method_type = method_type.lower()
     try:
         if method_type == "post":
-            return requests.post(url, headers=headers, data=args[0])
+            return session.post(url, headers=headers, data=args[0])
         if method_type == "get":
-            return requests.get(url, headers=headers, data=args[0])
+            return session.get(url, headers=headers, data=args[0])
     except requests.RequestException as exception:
         sys.exit(exception)
 
 
+def open_in_image_dir(dir_fd: int, name: str, flags: int) -> int:
+    """ Opener that resolves name relative to the already open images dir.
+
+    Args:
+      dir_fd (int): file descriptor of the open slack_emoji/images dir
+      name (str): file name within slack_emoji/images
+      flags (int): os.open flags supplied by open()
+
+    Returns:
+      int: file descriptor
+    """
+    return os.open(name, flags, 0o644, dir_fd=dir_fd)
+
+
+def remove_from_image_dir(dir_fd: int, name: str):
+    """ Remove a partially written image from the images dir, best effort.
+
+    Args:
+      dir_fd (int): file descriptor of the open slack_emoji/images dir
+      name (str): file name within slack_emoji/images
+    """
+    try:
+        os.unlink(name, dir_fd=dir_fd)
+    except OSError:
+        pass
+
+
+async def download_one(emoji: str, image: str, client: aiohttp.ClientSession,
+                       sem: asyncio.Semaphore, dir_fd: int) -> (str, bool):
+    """ Download a single emoji image into slack_emoji/images.
+
+    Args:
+      emoji (str): name of the emoji
+      image (str): url of the emoji image
+      client (aiohttp.ClientSession): shared client to download with
+      sem (asyncio.Semaphore): bounds the number of in-flight downloads
+      dir_fd (int): file descriptor of the open slack_emoji/images dir
+
+    Returns:
+      (str, bool): file name of the emoji and whether it was retrieved
+    """
+    # take the extension from the url path so query strings stay out of filenames
+    e = urlparse(image).path.rpartition('.')[2]
+    name = f"{emoji}.{e}"
+    opener: Callable[[str, int], int] = functools.partial(open_in_image_dir, dir_fd)
+    async with sem:
+        for attempt in range(retries):
+            opened = False
+            try:
+                async with client.get(image) as r:
+                    if r.status != 200:
+                        return name, False
+                    opened = True
+                    async with aiofiles.open(name, 'wb', opener=opener) as f:
+                        async for chunk in r.content.iter_chunked(1 << 20):
+                            await f.write(chunk)
+                return name, True
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+                # never leave a truncated image behind, retried or not
+                if opened:
+                    remove_from_image_dir(dir_fd, name)
+                if attempt + 1 < retries:
+                    await asyncio.sleep(0.5 * (attempt + 1))
+    return name, False
+
+
+async def download_all(emojii: dict, dir_fd: int):
+    """ Download all emoji images concurrently, ignoring aliases.
+
+    Args:
+      emojii (dict): emoji names mapped to image urls
+      dir_fd (int): file descriptor of the open slack_emoji/images dir
+    """
+    sem = asyncio.Semaphore(64)
+    connector = aiohttp.TCPConnector(limit=64, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as client:
+        downloads = [
+            download_one(emoji, image, client, sem, dir_fd)
+            for emoji, image in emojii.items()
+            if not image.startswith('alias:')
+        ]
+        for download in asyncio.as_completed(downloads):
+            name, ok = await download
+            if ok:
+                print('Image sucessfully Downloaded: ', name)
+            else:
+                print('Image Couldn\'t be retreived: ', name)
+
+
 # build our auth headers
 headers = {
     "Authorization": "Bearer " + os.environ["SLACK_TOKEN"]
@@ -55,26 +156,15 @@ resp   = request('get', 'https://slack.com/api/emoji.list', headers, {})
 emojii = resp.json()['emoji']
 
 # make slack_emoji/images dirs and store the emoji list
-if not os.path.exists('slack_emoji'):
-    os.makedirs('slack_emoji')
-if not os.path.exists('slack_emoji/images'):
-    os.makedirs('slack_emoji/images')
+os.makedirs('slack_emoji/images', exist_ok=True)
 with open('slack_emoji/emoji_list.json', 'w') as f:
-    f.write(json.dumps(emojii))
-
-# download all the images, ignore aliases
-p = re.compile(r'alias:.*')
-for emoji, image in emojii.items():
-    m = re.match(p, image)
-    if m:
-        continue
-    e = image.split('.')[-1]
-    r = requests.get(image, stream=True)
-    if r.status_code == 200:
-        r.raw.decode_content = True
-        with open('slack_emoji/images/' + emoji + '.' + e, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
-        print('Image sucessfully Downloaded: ', emoji + '.' + e)
-    else:
-        print('Image Couldn\'t be retreived: ', emoji + '.' + e)
-    r.close()
+    json.dump(emojii, f, separators=(',', ':'))
+
+# hold the images dir open so each image is created relative to it
+img_dir_fd = os.open('slack_emoji/images', os.O_RDONLY | os.O_DIRECTORY)
+
+# download all the images concurrently, ignore aliases
+try:
+    asyncio.run(download_all(emojii, img_dir_fd))
+finally:
+    os.close(img_dir_fd)
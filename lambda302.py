@@ -17,24 +17,22 @@
 
 import json
 
+# define our target S3 bucket
+BUCKET = "my-bucket-name"
+
+# define any json body we want to also pass back with the response
+EMPTY_BODY = json.dumps({})
 
-def lambda_handler(event, context):
-    # define our target S3 bucket
-    bucket = "my-bucket-name"
 
+def lambda_handler(event, context):
     # get the first subdomain from the url used to call this script
-    resource = event['headers']['Host'].split('.')[0]
+    resource = event['headers']['Host'].split('.', 1)[0]
 
     # craft our 302 response to redirect to the specified S3 bucket
-    response = {
+    return {
         "statusCode": 302,
         "headers": {
-            'Location': 'https://' + bucket + '.s3.amazonaws.com/' + resource
-        }
+            'Location': f"https://{BUCKET}.s3.amazonaws.com/{resource}"
+        },
+        "body": EMPTY_BODY,
     }
-
-    # define any json body we want to also pass back and append it to response
-    data = {}
-    response["body"] = json.dumps(data)
-
-    return response
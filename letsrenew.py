@@ -11,7 +11,7 @@
 # Author(s): Cody Buell
 #
 # Requisite: - python3
-#            - pip3: requests boto3
+#            - pip3: boto3 cryptography
 #            - certbot|certbot-auto
 #            - certificate already configured at least once
 #            - managed policy attached to ec2 iam role
@@ -51,11 +51,9 @@
 #        0 1 * * * /usr/local/bin/letsrenew.py > /var/log/letsrenew 2>&1
 
 import os
-import ssl
 import sys
-import boto3
-import socket
-import requests
+import json
+import subprocess
 import logging as l
 import datetime as dt
 
@@ -71,6 +69,10 @@ domain = 'mydomain.tld'
 # threshold for when certificate should be renewed in seconds
 threshold = 5 * 24 * 60 * 60
 
+# cache of the last seen certificate expiration, lets us skip the tls probe
+# when the certificate is nowhere near due
+cache_file = '/var/lib/letsrenew/cache.json'
+
 # pre command (services to stop, host prep work, etc)
 pre_command = """
     echo "pre command"
@@ -103,6 +105,11 @@ l.basicConfig(
         datefmt='%Y-%m-%d %H:%M:%S',
         )
 
+# instance metadata service, keep timeouts short so a hung metadata service
+# doesn't stall the renewal
+imds_host = '169.254.169.254'
+imds_timeout = 1
+
 ################################################################################
 ##                                                                            ##
 ##  Functions                                                                 ##
@@ -110,80 +117,132 @@ l.basicConfig(
 ################################################################################
 
 
-def request(method_type: str, url: str, headers: dict, *args: dict) -> requests.Response:
-    """Run a POST or GET request"""
-    method_type = method_type.lower()
+def request(conn: 'http.client.HTTPConnection', method_type: str, path: str, headers: dict) -> bytes:
+    """Run a request over an open connection and return the response body, exits
+    the process on a connection error or a non-200 response"""
+    method_type = method_type.upper()
+    l.debug('Running {} request to {}'.format(method_type, path))
     try:
-        if method_type == "post":
-            l.debug('Running post request to {}'.format(url))
-            return requests.post(url, headers=headers, data=args[0])
-        if method_type == "get":
-            l.debug('Running get request to {}'.format(url))
-            return requests.get(url, headers=headers, data=args[0])
-    except requests.RequestException as e:
+        conn.request(method_type, path, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+    except (OSError, http.client.HTTPException) as e:
         sys.exit(e)
+    if resp.status != 200:
+        sys.exit('{} {} returned {}'.format(method_type, path, resp.status))
+    return body
 
 
-def run_cmd(cmd: str) -> str:
-    """Run command against the OS"""
+def run_cmd(cmd: 'list or str', shell: bool = False) -> str:
+    """Run command against the OS, pass a string and shell=True for bash scripts"""
     l.debug('Running command: {}'.format(cmd))
-    out = (os.popen(cmd).read())
-    return out.rstrip()
+    proc = subprocess.run(cmd, shell=shell, executable='/bin/bash' if shell else None,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          text=True, check=False)
+    if proc.returncode != 0:
+        l.warning('Command exited {}: {}'.format(proc.returncode, cmd))
+    return proc.stdout.rstrip()
 
 
-def ssl_expiration(hostname: str) -> (dt.datetime, dt.datetime, int):
+def ssl_expiration(hostname: str) -> (dt.datetime, dt.timedelta, int):
     """Get the datetime of a certificates expiration."""
-    # define the certificate date format
-    ssl_date_fmt = r'%b %d %H:%M:%S %Y %Z'
-
-    # configure our socket
-    context = ssl.create_default_context()
-    conn = context.wrap_socket(
-        socket.socket(socket.AF_INET),
-        server_hostname=hostname,
-    )
-    conn.settimeout(3.0)
-
-    # establish the socket and grab the certificate
+    import ssl
+    from cryptography import x509
+
+    # grab the certificate, no need to verify it just to read the expiration
     l.debug('Connect to {}'.format(hostname))
     try:
-        conn.connect((hostname, 443))
-    except Exception as e:
-        print(e)
-        sys.exit()
-    ssl_info = conn.getpeercert()
-    conn.close()
+        pem = ssl.get_server_certificate((hostname, 443), timeout=3)
+    except OSError as e:
+        l.error('Unable to get certificate for {}: {}'.format(hostname, e))
+        raise
+    cert = x509.load_pem_x509_certificate(pem.encode())
 
     # parse the expiration into some dates and measures
-    expiration = dt.datetime.strptime(ssl_info['notAfter'], ssl_date_fmt)
-    remaining = expiration - dt.datetime.utcnow()
+    expiration = cert.not_valid_after_utc
+    remaining = expiration - dt.datetime.now(dt.timezone.utc)
     seconds_rem = int(remaining.total_seconds())
 
     return expiration, remaining, seconds_rem
 
 
-def get_security_group_by_name(ec2: 'boto3 ec2 client', name: str) -> 'sg id':
-    """Get the id of a SecurityGroup from the name."""
-    ec2 = boto3.client('ec2')
+def read_cached_expiration(hostname: str) -> dt.datetime:
+    """Get the cached certificate expiration for hostname, None if unknown."""
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        expiration = dt.datetime.fromisoformat(cache[hostname])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        l.debug('No usable cached expiration for {}: {}'.format(hostname, e))
+        return None
+
+    # we only ever write aware utc timestamps, anything else is not ours
+    if expiration.tzinfo is None:
+        l.debug('Ignoring naive cached expiration for {}'.format(hostname))
+        return None
+    return expiration
+
+
+def write_cached_expiration(hostname: str, expiration: dt.datetime):
+    """Atomically store the certificate expiration for hostname."""
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if not isinstance(cache, dict):
+        cache = {}
+    cache[hostname] = expiration.isoformat()
+
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        l.warning('Unable to write cache {}: {}'.format(cache_file, e))
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def get_security_group_by_name(ec2: 'boto3 ec2 client', name: str) -> 'sg description':
+    """Get the description (id and current rules) of a SecurityGroup from the name."""
     resp = ec2.describe_security_groups(
             Filters=[
                 dict(Name='group-name', Values=[name])
                 ]
             )
 
-    return resp['SecurityGroups'][0]['GroupId']
+    return resp['SecurityGroups'][0]
+
+
+def has_public_http_rule(security_group: 'sg description') -> bool:
+    """Check if a described SecurityGroup already opens the temp rule port to the
+    world, whatever the rule description."""
+    wanted = temp_rule[0]
+    for perm in security_group.get('IpPermissions', []):
+        if (perm.get('IpProtocol'), perm.get('FromPort'), perm.get('ToPort')) != \
+                (wanted['IpProtocol'], wanted['FromPort'], wanted['ToPort']):
+            continue
+        for ip_range in perm.get('IpRanges', []):
+            if ip_range.get('CidrIp') == wanted['IpRanges'][0]['CidrIp']:
+                return True
+    return False
 
 
 def add_rule_to_security_group(ec2: 'boto3 ec2 client', security_group: str):
     """Add temp rule to the specified SecurityGroup."""
-    sg = ec2.SecurityGroup(security_group)
-    sg.authorize_ingress(DryRun=False, IpPermissions=temp_rule)
+    ec2.authorize_security_group_ingress(
+            DryRun=False, GroupId=security_group, IpPermissions=temp_rule)
 
 
 def remove_rule_from_security_group(ec2: 'boto3 ec2 client', security_group: str):
     """Remove temp rule from the specified SecurityGroup."""
-    sg = ec2.SecurityGroup(security_group)
-    sg.revoke_ingress(DryRun=False, IpPermissions=temp_rule)
+    ec2.revoke_security_group_ingress(
+            DryRun=False, GroupId=security_group, IpPermissions=temp_rule)
 
 ################################################################################
 ##                                                                            ##
@@ -193,42 +252,70 @@ def remove_rule_from_security_group(ec2: 'boto3 ec2 client', security_group: str
 
 
 if __name__ == "__main__":
-    _, _, seconds_left = ssl_expiration(domain)
+    # skip the tls probe entirely if the cached expiration is comfortably out
+    cached = read_cached_expiration(domain)
+    now = dt.datetime.now(dt.timezone.utc)
+    if cached and (cached - now).total_seconds() > threshold + 86400:
+        l.info('Cached expiration for {} is {}, not renewing'.format(domain, cached))
+        sys.exit(0)
+
+    expiration, _, seconds_left = ssl_expiration(domain)
+    write_cached_expiration(domain, expiration)
     # if we are under our threshold for time remaining on cert run our renewal
     if seconds_left < threshold:
         # execute the pre-command
         print('Running pre-command')
-        out = run_cmd(pre_command)
+        out = run_cmd(pre_command, shell=True)
         print(out)
 
+        # get an imdsv2 session token for the metadata calls below, all calls
+        # share one keep-alive connection, http.client pulls in ssl so only
+        # import it when we actually need to renew
+        import http.client
+        imds = http.client.HTTPConnection(imds_host, timeout=imds_timeout)
+        token = request(
+            imds, 'put', '/latest/api/token',
+            {'X-aws-ec2-metadata-token-ttl-seconds': '60'}).decode()
+        imds_headers = {'X-aws-ec2-metadata-token': token}
+
         # get the region of the ec2 instance we are running on
         resp = request(
-            'get', 'http://169.254.169.254/latest/dynamic/instance-identity/document', {}, {})
-        region = resp.json()['region']
+            imds, 'get', '/latest/dynamic/instance-identity/document', imds_headers)
+        region = json.loads(resp)['region']
 
-        # initialialize boto3
-        ec2 = boto3.client('ec2')
+        # initialialize boto3 once for all ec2 calls, only pay for the import
+        # when we actually need to renew
+        import boto3
+        ec2 = boto3.client('ec2', region_name=region)
 
-        # get the security groups attached to this node
+        # get the security groups attached to this node along with its current rules
         resp = request(
-            'get', 'http://169.254.169.254/latest/meta-data/security-groups', {}, {})
-        security_group = get_security_group_by_name(ec2, resp.text)
-
-        # temporarily open up the security group port 80 to the world, tag rule to easily identify
-        add_rule_to_security_group(ec2, security_group)
-
-        # perform certificate renewal for the domain
-        out = run_cmd(f"""\
-            certbot -n -d {domain} --standalone certonly
-            # certbot-auto -n -d {domain} --standalone certonly
-            """
-
-        # delete out the temoprary security group rule using the tag to identify
-        remove_rule_from_security_group(ec2, security_group)
+            imds, 'get', '/latest/meta-data/security-groups', imds_headers)
+        imds.close()
+        sg_desc = get_security_group_by_name(ec2, resp.decode())
+        security_group = sg_desc['GroupId']
+
+        # temporarily open up the security group port 80 to the world, tag rule to easily identify,
+        # if port 80 is already open leave the existing rule alone and never revoke it
+        added = False
+        try:
+            if has_public_http_rule(sg_desc):
+                l.info('Port 80 already open on {}, not adding temp rule'.format(security_group))
+            else:
+                add_rule_to_security_group(ec2, security_group)
+                added = True
+
+            # perform certificate renewal for the domain
+            out = run_cmd(['certbot', '-n', '-d', domain, '--standalone', 'certonly'])
+            # out = run_cmd(['certbot-auto', '-n', '-d', domain, '--standalone', 'certonly'])
+        finally:
+            # delete out the temoprary security group rule if we added it, even if certbot fails
+            if added:
+                remove_rule_from_security_group(ec2, security_group)
 
         # TODO: parse renewal output for location of new certificates
 
         # execute the post command
         print('Running post-command')
-        out=run_cmd(pre_command)
+        out = run_cmd(post_command, shell=True)
         print(out)
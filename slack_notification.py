@@ -21,20 +21,27 @@ import urllib3
 
 SLACK_WEBHOOK  = os.getenv('SLACK_WEBHOOK')
 
+# module scoped pool so warm lambda invocations reuse the connection to slack
+HTTP = urllib3.PoolManager(num_pools=1, maxsize=4, retries=urllib3.Retry(3, backoff_factor=0.1))
+
 slack_payload = json.dumps({
     'channel': '#test',
     'username': 'devops',
     'icon_emoji': ':hubot:',
     'text': 'Hello Slack!',
 })
+SLACK_BODY = slack_payload.encode('utf-8')
+SLACK_HEADERS = {
+    'Content-Type': 'application/json',
+    'Content-Length': str(len(SLACK_BODY)),
+}
 
 
 def lambda_handler(event: dict, context: dict) -> dict:
-    http = urllib3.PoolManager()
-    resp = http.request('POST', SLACK_WEBHOOK, headers={'Content-Type': 'application/json'}, body=slack_payload)
+    resp = HTTP.request('POST', SLACK_WEBHOOK, headers=SLACK_HEADERS, body=SLACK_BODY)
     return {
         'statusCode': resp.status,
-        'body': json.dumps(slack_payload)
+        'body': slack_payload
     }
 
 